@@ -19,9 +19,12 @@
 
 import os
 import binascii
+import errno
+import itertools
 import time
 import random
 import gevent
+import gevent.pool
 import gevent.ssl
 from gevent import Greenlet
 from gevent import socket
@@ -29,14 +32,22 @@ from gevent.queue import Queue, Empty
 from gevent.lock import RLock
 import struct
 import traceback
+# only loads() is used here; orjson is the fastest on the small
+# dict-shaped bodies we decode, ujson the next best
 try:
-    import ujson as json
+    import orjson as json
 except ImportError:
-    import json
+    try:
+        import ujson as json
+    except ImportError:
+        import json
 from config import *
 from cross_platform import *
 from Message import MessageObj
 from DataMgr import InconsistentError
+# prefer the C-accelerated protobuf backend, the pure python
+# (de)serializer is an order of magnitude slower on the per-packet path
+os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'cpp')
 import gw_message_pb2
 from db_helper import mysql
 
@@ -51,7 +62,26 @@ MSG_GROUP = 0x20
 MSG_EVENT = 0x40
 MSG_ERROR = 0x80000000
 
+# Container.BTYPE enumeration, control metadata that used to ride
+# in the JSON BODY as {'type': ...}
+BODY_NONE = 0x0
+BODY_RECEIPT = 0x1
+BODY_ONLINE = 0x2
+BODY_OFFLINE = 0x3
+
 MAX_PACKET_LENGTH = 1 << 20
+# coalesce at most this many octets of queued packets into one write
+MAX_COALESCE_LENGTH = 16 << 10
+# how much to ask the SSL layer for per read on the receive path
+RECV_CHUNK_LENGTH = 64 << 10
+
+# precompiled length-prefix codec, avoids re-parsing the format
+# string on every packet
+_LEN = struct.Struct('>I')
+
+# transient TLS backpressure (dedicated exception on 2.7.9+), older
+# runtimes surface it as a plain EAGAIN socket.error
+_SSLWantWriteError = getattr(gevent.ssl, 'SSLWantWriteError', None)
 
 class Error(Exception):
     pass
@@ -66,20 +96,50 @@ class MaxLengthError(Error):
 
 class Packet(object):
 
+    # free-list of Container instances, reused via Clear() so the hot
+    # pack/unpack path does not re-run message construction every time
+    _container_pool = []
+    _CONTAINER_POOL_MAX = 32
+
+    @staticmethod
+    def Obtain():
+        """get a (cleared) Container from the free-list"""
+        try:
+            msg = Packet._container_pool.pop()
+        except IndexError:
+            return gw_message_pb2.Container()
+        msg.Clear()
+        return msg
+
+    @staticmethod
+    def Release(msg):
+        """give back a Container for later reuse"""
+        if len(Packet._container_pool) < Packet._CONTAINER_POOL_MAX:
+            Packet._container_pool.append(msg)
+
     @staticmethod
     def Pack(message):
+        # single allocation: header and payload written into one
+        # bytearray, which gw_fd.write accepts as-is
         raw = message.SerializeToString()
-        length = len(raw)
-        data = struct.pack('>I', length)
-        data += raw
+        n = len(raw)
+        data = bytearray(4 + n)
+        _LEN.pack_into(data, 0, n)
+        data[4:] = raw
         return data
 
     @staticmethod
     def UnPack(data):
+        """parse one framed Container out of a bytes-like buffer
+
+        returns (msg, consumed) so the caller can trim its buffer
+        in place instead of reslicing it
+        """
         if len(data) < 4:
             raise DataNeededError('At least 4 octets')
 
-        length = struct.unpack('>I', data[:4])[0]
+        mv = memoryview(data)
+        length = _LEN.unpack_from(mv)[0]
 
         if length > MAX_PACKET_LENGTH :
             raise MaxLengthError('')
@@ -87,15 +147,53 @@ class Packet(object):
         if len(data) < (4 + length):
             raise DataNeededError('Need more data')
 
-        data = data[4:4 + length]
-        msg = gw_message_pb2.Container()
-        msg.ParseFromString(data)
+        msg = Packet.Obtain()
+        msg.ParseFromString(mv[4:4 + length].tobytes())
 
-        return msg
+        return msg, 4 + length
+
+class Framer(object):
+    """stateful streaming parser for length-prefixed Containers
+
+    remembers the expected frame length across feeds, so each header
+    is unpacked exactly once no matter how the stream is chunked
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._len = None
+
+    def feed(self, data):
+        """buffer a chunk and yield every Container it completes
+
+        yielded messages come from the Packet free-list, hand them
+        back with Packet.Release() when done with them
+        """
+        buf = self._buf
+        buf.extend(data)
+        while True:
+            if self._len is None:
+                if len(buf) < 4:
+                    return
+                self._len = _LEN.unpack_from(buf)[0]
+                if self._len > MAX_PACKET_LENGTH:
+                    raise MaxLengthError('frame of %d octets' % self._len)
+                del buf[:4]
+            if len(buf) < self._len:
+                return
+            msg = Packet.Obtain()
+            msg.ParseFromString(memoryview(buf)[:self._len].tobytes())
+            del buf[:self._len]
+            self._len = None
+            yield msg
 
 class GatewayMgr(object):
     PUSH_SERVER_SID = '00000001'
 
+    # TLS context shared by all (re)connects, built once so OpenSSL
+    # can reuse session material between handshakes where supported
+    _ssl_ctx = None
+
     def __init__(self, logger, send_queue, online_callback_func, offline_callback_func):
         """initialize GateManager
 
@@ -109,12 +207,42 @@ class GatewayMgr(object):
             :type offline_callback_func: lambda,instancemethod,function
         """
         self.logger = logger
+        try:
+            from google.protobuf.internal import api_implementation
+            if api_implementation.Type() not in ('cpp', 'upb'):
+                self.logger.warning('[GM] protobuf is using the pure python backend, '
+                    'install the binary wheel for native (de)serialization')
+        except ImportError:
+            pass
         self.online_callback = online_callback_func
         self.offline_callback = offline_callback_func
         self._gw_fd_raw = None
         self.gw_fd = None
+        # template with the invariant fields preset, per-push code
+        # only fills in RID/MID/TYPE/BODY
+        self._tmpl = gw_message_pb2.Container()
+        self._tmpl.SID = GatewayMgr.PUSH_SERVER_SID
+        self._tmpl.STIME = 0
+        # auto message IDs: one-off random prefix plus a counter is
+        # unique for the process lifetime and avoids a urandom
+        # syscall per push
+        self._mid_prefix = binascii.hexlify(os.urandom(4))
+        self._mid_counter = itertools.count()
+        # single long-lived DB connection for offline events, the
+        # per-event TCP+auth handshake dwarfed the query itself
+        try:
+            self.mysql_instance = mysql()
+        except Exception:
+            # DB not reachable yet, retry on first offline event
+            self.mysql_instance = None
         self.callback_tbl = {}
         self._send_queue = send_queue
+        # updated by _send after every successful write, lets the
+        # heartbeat skip beats while other traffic keeps the link warm
+        self._last_send_ts = 0
+        # receipt callbacks run here instead of inside _recv, so a
+        # slow callback cannot stall inbound frame parsing
+        self._cb_pool = gevent.pool.Pool(size = 64)
         self.connect()
         self.greenlets = [
             gevent.spawn(self._send),
@@ -125,9 +253,50 @@ class GatewayMgr(object):
 
     def connect(self):
         """establish ssl(tls) connection over TCP"""
+        if GatewayMgr._ssl_ctx is None:
+            GatewayMgr._ssl_ctx = gevent.ssl.SSLContext(gevent.ssl.PROTOCOL_SSLv23)
         self._gw_fd_raw = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._gw_fd_raw.connect((GATEWAY_HOST, GATEWAY_PORT))
-        self.gw_fd = gevent.ssl.SSLSocket(self._gw_fd_raw)
+        # disable Nagle, corking around batched writes (see _send)
+        # decides when data actually hits the wire
+        self._gw_fd_raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.gw_fd = GatewayMgr._ssl_ctx.wrap_socket(self._gw_fd_raw)
+
+    def _reconnect(self):
+        """tear down and re-establish the gateway link
+
+        retries with exponential backoff until the link is up, so a
+        flapping gateway does not spin the send loop
+        """
+        delay = 1
+        while True:
+            if self._gw_fd_raw:
+                try:
+                    self._gw_fd_raw.close()
+                except:
+                    pass
+            self._gw_fd_raw = None
+            self.gw_fd = None
+            try:
+                self.connect()
+            except socket.error as ex:
+                self.logger.warning('[GM] reconnect failed (%s), retry in %ds' % (ex, delay))
+                gevent.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                return
+
+    def _cork(self, flag):
+        """hold/release sub-MTU data in kernel while a batch is written
+
+        no-op on platforms without TCP_CORK (non-linux)
+        """
+        if not hasattr(socket, 'TCP_CORK'):
+            return
+        try:
+            self._gw_fd_raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_CORK, flag)
+        except socket.error:
+            pass
 
     def auth(self):
         """queued the authenication packge"""
@@ -164,30 +333,64 @@ class GatewayMgr(object):
             :param mid: message ID
             :type mid: int
         """
-        mid = 'PSH' + (mid or binascii.hexlify(os.urandom(9)))
-        msg = gw_message_pb2.Container()
-        msg.SID = GatewayMgr.PUSH_SERVER_SID
+        if mid is None:
+            mid = 'PSH%s%012x' % (self._mid_prefix, next(self._mid_counter))
+        else:
+            mid = 'PSH' + mid
+        msg = Packet.Obtain()
+        msg.CopyFrom(self._tmpl)
         msg.RID = rid
         msg.MID = mid
-        msg.STIME = 0
         msg.TYPE = msgtype
         msg.BODY = body#'{"token":"foo"}'
 
         data = Packet.Pack(msg)
+        Packet.Release(msg)
         # put in send queue
         self._send_queue.put(data)
         if callback:
             self.callback_tbl[mid] = callback
 
+    def _write_all(self, b):
+        """write b to the gateway in full, riding out backpressure
+
+        transient conditions (SSL want-write / EAGAIN) only wait for
+        the socket to drain and retry; real errors propagate so the
+        caller can tear down and reconnect instead of rebuilding the
+        TLS session on every hiccup
+        """
+        while True:
+            try:
+                self.gw_fd.sendall(b)
+            except socket.error as ex:
+                if _SSLWantWriteError is not None and isinstance(ex, _SSLWantWriteError):
+                    socket.wait_write(self.gw_fd.fileno())
+                    continue
+                if ex.args and ex.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    socket.wait_write(self.gw_fd.fileno())
+                    continue
+                raise
+            else:
+                return
+
     def _send(self):
         while True:
             b = self._send_queue.get()
+            # drain whatever else is pending into one write: each packet
+            # is length-prefixed so the receiver reassembles as before,
+            # while we pay a single syscall/TLS record for the batch
+            while len(b) < MAX_COALESCE_LENGTH:
+                try:
+                    b += self._send_queue.get_nowait()
+                except Empty:
+                    break
             ok = False
             for _ in range(2):
                 if not self.gw_fd or not self._gw_fd_raw:
-                    self.connect()
+                    self._reconnect()
+                self._cork(1)
                 try:
-                    self.gw_fd.write(b)
+                    self._write_all(b)
                 except socket.error:
                     try:
                         self._gw_fd_raw.close()
@@ -196,6 +399,8 @@ class GatewayMgr(object):
                     self._gw_fd_raw = None
                     self.gw_fd = None
                 else:
+                    self._cork(0)
+                    self._last_send_ts = time.time()
                     ok = True
                 if ok:
                     break
@@ -203,31 +408,46 @@ class GatewayMgr(object):
                 self.logger.warn("failed to send packet")
 
     def _recv(self):
-        buf = ''
+        # large reads feed a stateful framer, one read drains many
+        # queued frames and no header is ever parsed twice
+        framer = Framer()
         while True:
             try:
-                #print('wait for read')
-                socket.wait_read(self.gw_fd.fileno())
+                data = self.gw_fd.read(RECV_CHUNK_LENGTH)
             except socket.error:
                 break
-            #print('read')
-            buf += self.gw_fd.read()
-            if len(buf) == 0:
-                continue
-            try:
-                msg = Packet.UnPack(buf) # Must catch error
-            except DataNeededError:
-                continue
-            else:
-                buf = ''
+            if not data:
+                # peer closed the connection
+                break
             try:
-                self._resp_handler(msg)
-            except KeyboardInterrupt:
+                for msg in framer.feed(data):
+                    try:
+                        self._resp_handler(msg)
+                    except KeyboardInterrupt:
+                        return
+                    finally:
+                        Packet.Release(msg)
+            except MaxLengthError:
+                self.logger.warning('[GM] oversized frame, dropping link')
                 break
 
+    def _run_callback(self, func, status):
+        """invoke a registered callback off the _recv greenlet"""
+        try:
+            func(status)
+        except Exception as ex:
+            self.logger.error('[GM] Got "%s" in callback' % ex)
+            traceback.print_exc()
+
     def _heartbeat(self):
         while True:
             gevent.sleep(HEARTBEAT_INTERV - random.random() * 3 - 3)
+            # skip the beat only when a write landed since the last
+            # wakeup; the threshold sits below the shortest jittered
+            # sleep (HEARTBEAT_INTERV - 6) so the beat's own write
+            # never suppresses the next one on an idle link
+            if time.time() - self._last_send_ts < HEARTBEAT_INTERV - 6:
+                continue
             self._queued_send(
                 '0',
                 MSG_HEARTBEAT,
@@ -236,40 +456,49 @@ class GatewayMgr(object):
             #self.logger.debug("SENT heartbeat")
 
 
-    def _resp_handler(self, msg):
-        """response handler"""
+    def _resp_handler(self, msg, _MSG_CLIENT = MSG_CLIENT, _MSG_EVENT = MSG_EVENT,
+                      _STATUS_SUCCESS = MessageObj.STATUS_SUCCESS):
+        """response handler
+
+        the trailing defaults bind per-message constants as locals
+        (LOAD_FAST instead of LOAD_GLOBAL/LOAD_ATTR), do not pass them
+        """
         #self.logger.debug("MID=%s" % msg.MID)
-        if msg.BODY:
+        btype = msg.BTYPE
+        rmid = msg.RMID
+        if btype == BODY_NONE and msg.BODY:
+            # legacy peer: control metadata still rides in the JSON BODY
             msg_body = json.loads(msg.BODY)
-        else:
-            msg_body = {}
+            _t = msg_body.get('type')
+            if _t == 'receipt':
+                btype = BODY_RECEIPT
+                rmid = msg_body.get('mid')
+            elif _t == 'online':
+                btype = BODY_ONLINE
+            elif _t == 'offline':
+                btype = BODY_OFFLINE
         #print(msg)
-        if msg.TYPE & MSG_CLIENT:#client
-            if msg_body['type'] == 'receipt':#is receipt
-                mid = msg_body['mid']
+        if msg.TYPE & _MSG_CLIENT:#client
+            if btype == BODY_RECEIPT:#is receipt
+                mid = rmid
                 self.logger.debug('%s confirmed %s' % (msg.SID, mid))
-                if mid in self.callback_tbl:#has registered callback
-                    _func = self.callback_tbl.pop(mid)
-                    try:
-                        _func(MessageObj.STATUS_SUCCESS)
-                    except KeyboardInterrupt:
-                        raise KeyboardInterrupt
-                    except Exception as ex:
-                        self.logger.error('[GM] Got "%s" in callback' % ex)
-                        traceback.print_exc()
+                _func = self.callback_tbl.pop(mid, None)
+                if _func is not None:#has registered callback
+                    self._cb_pool.spawn(self._run_callback, _func, _STATUS_SUCCESS)
             else:
                 self.logger.debug('***INCOMING FROM [%s]:%s***' % (msg.SID, msg.BODY))
         else:#server
-            if msg.TYPE & MSG_EVENT:#is user event
-                if msg_body['type'] == 'online':
+            if msg.TYPE & _MSG_EVENT:#is user event
+                if btype == BODY_ONLINE:
                     self.logger.debug('[GM] user %s is now online' % msg.SID)
                     try:
                         self.online_callback(msg.SID)
                     except InconsistentError as ex:
                         self.logger.warning('error during setting %s online: %s' % (msg.SID, ex))
-                elif msg_body['type'] == 'offline':
+                elif btype == BODY_OFFLINE:
                     #if user offline,delete the data from the msyql database
-                    self.mysql_instance = mysql()
+                    if self.mysql_instance is None:
+                        self.mysql_instance = mysql()
                     self.logger.debug('[GM] user %s is now offline' % msg.SID)
                     try:
                         self.mysql_instance.delToOnlineTable(msg.SID)
@@ -282,18 +511,9 @@ class GatewayMgr(object):
                 
 
 
-    @staticmethod
-    def set_bit(int_type, offset):
-        mask = 1 << offset
-        return (int_type | mask)
-
-    @staticmethod
-    def test_bit(int_type, offset):
-        mask = 1 << offset
-        return (int_type & mask)
-
     def shutdown(self):
         gevent.joinall(self.greenlets)
+        self._cb_pool.join()
         self.gw_fd.close()
 
 
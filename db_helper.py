@@ -20,14 +20,22 @@ class mysql(object):
     def __init__(self):
         self.conn = MySQLdb.connect("127.0.0.1", MYSQL_USER, MYSQL_PASSWD, "Register")
 
+    def _ensure_connected(self):
+        #keep the long-lived connection, reconnect only when the server
+        #has dropped it
+        try:
+            self.conn.ping(True)
+        except Exception:
+            self.conn = MySQLdb.connect("127.0.0.1", MYSQL_USER, MYSQL_PASSWD, "Register")
+
     def delToOnlineTable(self, uid):
         try:
+            self._ensure_connected()
             cur = self.conn.cursor()
             sql_str = "delete from OnlineUser where uid = \"%s\" " % (uid)
             cur.execute(sql_str)
             self.conn.commit()
             cur.close()
-            self.conn.close()
         except Exception, e:
             print(e)
 
@@ -18,7 +18,7 @@ _sym_db = _symbol_database.Default()
 DESCRIPTOR = _descriptor.FileDescriptor(
   name='message.proto',
   package='message',
-  serialized_pb=_b('\n\rmessage.proto\x12\x07message\"]\n\tContainer\x12\x0b\n\x03MID\x18\x01 \x01(\t\x12\x0b\n\x03SID\x18\x02 \x02(\t\x12\x0b\n\x03RID\x18\x03 \x02(\t\x12\x0c\n\x04TYPE\x18\x04 \x02(\r\x12\r\n\x05STIME\x18\x05 \x02(\x03\x12\x0c\n\x04\x42ODY\x18\x06 \x02(\t')
+  serialized_pb=_b('\n\rmessage.proto\x12\x07message\"z\n\tContainer\x12\x0b\n\x03MID\x18\x01 \x01(\t\x12\x0b\n\x03SID\x18\x02 \x02(\t\x12\x0b\n\x03RID\x18\x03 \x02(\t\x12\x0c\n\x04TYPE\x18\x04 \x02(\r\x12\r\n\x05STIME\x18\x05 \x02(\x03\x12\x0c\n\x04\x42ODY\x18\x06 \x02(\t\x12\r\n\x05\x42TYPE\x18\x07 \x01(\r\x12\x0c\n\x04RMID\x18\x08 \x01(\t')
 )
 _sym_db.RegisterFileDescriptor(DESCRIPTOR)
 
@@ -74,6 +74,20 @@ _CONTAINER = _descriptor.Descriptor(
       message_type=None, enum_type=None, containing_type=None,
       is_extension=False, extension_scope=None,
       options=None),
+    _descriptor.FieldDescriptor(
+      name='BTYPE', full_name='message.Container.BTYPE', index=6,
+      number=7, type=13, cpp_type=3, label=1,
+      has_default_value=False, default_value=0,
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
+    _descriptor.FieldDescriptor(
+      name='RMID', full_name='message.Container.RMID', index=7,
+      number=8, type=9, cpp_type=9, label=1,
+      has_default_value=False, default_value=_b("").decode('utf-8'),
+      message_type=None, enum_type=None, containing_type=None,
+      is_extension=False, extension_scope=None,
+      options=None),
   ],
   extensions=[
   ],
@@ -86,7 +100,7 @@ _CONTAINER = _descriptor.Descriptor(
   oneofs=[
   ],
   serialized_start=26,
-  serialized_end=119,
+  serialized_end=148,
 )
 
 DESCRIPTOR.message_types_by_name['Container'] = _CONTAINER